@@ -6,30 +6,50 @@ Exposes container metrics via SNMP using the pass_persist protocol.
 import sys
 import time
 import argparse
+import bisect
+import functools
 import hashlib
-
-try:
-    import requests
-except ImportError:
-    print("ERROR: 'requests' module is not installed.", file=sys.stderr)
-    print("Install it with: pip3 install requests", file=sys.stderr)
-    sys.exit(1)
+import threading
+from operator import attrgetter
+
+from cadvisor_common import (
+    api_url,
+    dget,
+    fetch_containers,
+    get_mem,
+    get_name,
+    parse_timestamp,
+    state_cutoff,
+)
 
 BASE_OID = ".1.3.6.1.4.1.424242.2.1"
-
+_OID_PREFIX = BASE_OID.lstrip(".") + "."
+# Seconds since the last stats sample after which a container counts as stopped.
+STATE_MAX_AGE = 120
+# Upper bound for --cache-ttl, in seconds.
+MAX_CACHE_TTL = 86400
+
+class Row:
+    """Metrics for one container, i.e. one row of the SNMP table."""
+    __slots__ = ("index", "name", "state", "cpuHundredths", "memBytes", "memLimitBytes", "restartCount")
+
+    def __init__(self, index: int, name: str, state: int, cpuHundredths: int,
+                 memBytes: int, memLimitBytes: int, restartCount: int):
+        self.index = index
+        self.name = name
+        self.state = state
+        self.cpuHundredths = cpuHundredths
+        self.memBytes = memBytes
+        self.memLimitBytes = memLimitBytes
+        self.restartCount = restartCount
+
+@functools.lru_cache(maxsize=1024)
 def stable_index(name: str) -> int:
     """Generate a stable numeric index from container name."""
     h = hashlib.sha1(name.encode("utf-8")).digest()
     return int.from_bytes(h[:2], "big") or 1
 
-def fetch_containers(cadvisor_url: str, timeout: float = 2.0):
-    """Fetch container data from cAdvisor API."""
-    url = cadvisor_url.rstrip("/") + "/api/v1.3/docker"
-    r = requests.get(url, timeout=timeout)
-    r.raise_for_status()
-    return r.json()
-
-def calc_cpu_hundredths(c):
+def calc_cpu_hundredths(c: dict) -> int:
     """Calculate CPU usage percentage in hundredths (0-10000)."""
     stats = c.get("stats", [])
     if len(stats) < 2:
@@ -37,137 +57,99 @@ def calc_cpu_hundredths(c):
 
     a = stats[-2]
     b = stats[-1]
-    cu_a = a.get("cpu", {}).get("usage", {}).get("total", 0)
-    cu_b = b.get("cpu", {}).get("usage", {}).get("total", 0)
-    ts_a = a.get("timestamp")
-    ts_b = b.get("timestamp")
-
-    def parse_ts(t):
-        """Parse RFC3339 timestamp."""
-        if not t:
-            return None
-        try:
-            base = t.split(".")[0]
-            if base.endswith("Z"):
-                base = base[:-1]
-            elif "+" in base:
-                base = base.split("+")[0]
-            elif base.count("-") > 2:
-                parts = base.rsplit("-", 2)
-                if len(parts) >= 3 and ":" in parts[-1]:
-                    base = "-".join(parts[:-1])
-            return time.strptime(base, "%Y-%m-%dT%H:%M:%S")
-        except Exception:
-            return None
-
-    try:
-        parsed_a = parse_ts(ts_a)
-        parsed_b = parse_ts(ts_b)
-        if not parsed_a or not parsed_b:
-            return 0
-        ta = time.mktime(parsed_a)
-        tb = time.mktime(parsed_b)
-    except Exception:
+    cu_a = dget(a, "cpu", "usage", "total", default=0)
+    cu_b = dget(b, "cpu", "usage", "total", default=0)
+    ta = parse_timestamp(dget(a, "timestamp"))
+    tb = parse_timestamp(dget(b, "timestamp"))
+    if ta is None or tb is None:
         return 0
 
     dt = max(0.001, tb - ta)
     delta_ns = max(0, cu_b - cu_a)
     cpu_seconds = delta_ns / 1e9
-    cpu_limit = c.get("spec", {}).get("cpu", {}).get("limit", 0)
+    cpu_limit = dget(c, "spec", "cpu", "limit", default=0)
     if cpu_limit and cpu_limit > 0:
         cpus = cpu_limit
     else:
-        cpus = max(1, c.get("spec", {}).get("cpu", {}).get("count", 1))
+        cpus = max(1, dget(c, "spec", "cpu", "count", default=1))
     pct = min(100.0, (cpu_seconds / dt) * 100.0 / cpus)
     return int(round(pct * 100))
 
-def get_state(c):
-    """Get container state: 1=running, 2=stopped."""
+def get_state(c: dict, now: float | None = None, cutoff: str | None = None) -> int:
+    """Get container state: 1=running, 2=stopped.
+
+    Pass cutoff (see state_cutoff()) to skip parsing UTC timestamps.
+    """
     stats = c.get("stats", [])
     if not stats:
         return 2
-    ts = stats[-1].get("timestamp")
-    try:
-        t_last = time.mktime(time.strptime(ts.split(".")[0], "%Y-%m-%dT%H:%M:%S"))
-        if time.time() - t_last < 120:
-            return 1
-    except Exception:
-        pass
+    ts = dget(stats[-1], "timestamp")
+    if cutoff is not None and ts and len(ts) >= 20 and ts[10] == "T" and ts[-1] == "Z":
+        return 1 if ts[:19] >= cutoff else 2
+    t_last = parse_timestamp(ts)
+    if now is None:
+        now = time.time()
+    if t_last is not None and now - t_last < STATE_MAX_AGE:
+        return 1
     return 2
 
-def get_mem(c):
-    """Get memory usage and limit in bytes."""
-    stats = c.get("stats", [])
-    if not stats:
-        return 0, 0
-    m = stats[-1].get("memory", {})
-    usage = int(m.get("usage", 0))
-    limit = int(c.get("spec", {}).get("memory", {}).get("limit", 0))
-    return usage, limit
-
-def get_name(c_id: str, c: dict) -> str:
-    """Extract container name from various sources."""
-    n = c.get("aliases") or []
-    if n:
-        return n[0].lstrip("/")
-    name = c.get("spec", {}).get("labels", {}).get("io.kubernetes.container.name")
-    if name:
-        return name
-    return c.get("name", c_id)[:12].lstrip("/")
-
 def get_restart_count(c: dict) -> int:
     """Get restart count from labels."""
-    restart = c.get("spec", {}).get("labels", {}).get("com.docker.compose.container-number")
+    restart = dget(c, "spec", "labels", "com.docker.compose.container-number")
     try:
         return int(restart)
     except Exception:
         return 0
 
-def build_rows(cadvisor_url: str):
+def build_rows(url: str) -> list[Row]:
     """Build rows of container metrics from cAdvisor data."""
     try:
-        data = fetch_containers(cadvisor_url)
+        # calc_cpu_hundredths and get_state only look at the last 2 samples.
+        data = fetch_containers(url, num_stats=2)
     except Exception as e:
         print(f"ERROR: Failed to fetch from cAdvisor: {e}", file=sys.stderr)
         sys.stderr.flush()
         return []
 
+    now = time.time()
+    cutoff = state_cutoff(now, STATE_MAX_AGE)
     rows = []
-    for cid, c in sorted(data.items()):
+    for cid, c in data.items():
         try:
             name = get_name(cid, c)
             idx = stable_index(name)
-            state = get_state(c)
+            state = get_state(c, now, cutoff)
             cpu = calc_cpu_hundredths(c)
             mem, memlimit = get_mem(c)
             restarts = get_restart_count(c)
-            rows.append({
-                "index": idx,
-                "name": name,
-                "state": state,
-                "cpuHundredths": cpu,
-                "memBytes": int(mem),
-                "memLimitBytes": int(memlimit),
-                "restartCount": int(restarts),
-            })
+            rows.append(Row(idx, name, state, cpu, mem, memlimit, restarts))
         except Exception as e:
             print(f"ERROR: Failed to process container {cid}: {e}", file=sys.stderr)
             sys.stderr.flush()
             continue
 
-    used = set()
+    # Rows whose stable_index is unique keep it. Colliding rows are then
+    # probed upwards into free slots, in name order so the outcome doesn't
+    # depend on cAdvisor's ordering.
+    counts = {}
     for r in rows:
-        i = r["index"]
-        while i in used:
-            i += 1
-        used.add(i)
-        r["index"] = i
-    
-    rows.sort(key=lambda x: x["index"])
+        counts[r.index] = counts.get(r.index, 0) + 1
+    used = {r.index for r in rows if counts[r.index] == 1}
+    for r in sorted((r for r in rows if counts[r.index] > 1), key=attrgetter("name")):
+        idx = r.index
+        while idx in used:
+            idx += 1
+        used.add(idx)
+        r.index = idx
+    rows.sort(key=attrgetter("index"))
     return rows
 
-def oid_to_tuple(oid_str):
-    """Convert OID string to tuple of integers for comparison."""
+@functools.lru_cache(maxsize=4096)
+def oid_to_tuple(oid_str: str) -> tuple[int, ...]:
+    """Convert OID string to tuple of integers for comparison.
+
+    Memoized: the same OIDs are requested on every walk of the table.
+    """
     if not oid_str:
         return tuple()
     oid_str = oid_str.lstrip(".")
@@ -179,7 +161,17 @@ def oid_to_tuple(oid_str):
     except (ValueError, AttributeError):
         return tuple()
 
-def normalize_oid(oid):
+def cache_ttl_seconds(value: str) -> float:
+    """argparse type for --cache-ttl: seconds, greater than 0 and at most a day."""
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number: {value!r}")
+    if not 0 < number <= MAX_CACHE_TTL:
+        raise argparse.ArgumentTypeError(f"must be greater than 0 and at most {MAX_CACHE_TTL}: {value!r}")
+    return number
+
+def normalize_oid(oid: str) -> str:
     """Normalize OID by removing leading dot."""
     return oid.lstrip(".") if oid.startswith(".") else oid
 
@@ -191,21 +183,24 @@ def main():
                     help="cAdvisor base URL (or set CADVISOR_URL env var)")
     ap.add_argument("--test", action="store_true",
                     help="Test mode: fetch data and display it, then exit")
+    ap.add_argument("--cache-ttl", type=cache_ttl_seconds, default=5.0,
+                    help="Seconds between background refreshes of cAdvisor data, up to 86400 (default: 5)")
     args = ap.parse_args()
+    url = api_url(args.url)
 
     if args.test:
         print("Testing cAdvisor connection...", file=sys.stderr)
         try:
-            rows = build_rows(args.url)
+            rows = build_rows(url)
             print(f"✓ Successfully connected to cAdvisor at {args.url}", file=sys.stderr)
             print(f"✓ Found {len(rows)} containers\n", file=sys.stderr)
             for r in rows:
-                print(f"Container: {r['name']}")
-                print(f"  Index: {r['index']}")
-                print(f"  State: {'Running' if r['state'] == 1 else 'Stopped'}")
-                print(f"  CPU: {r['cpuHundredths']/100:.2f}%")
-                print(f"  Memory: {r['memBytes']/1024/1024:.2f} MB / {r['memLimitBytes']/1024/1024:.2f} MB")
-                print(f"  Restarts: {r['restartCount']}")
+                print(f"Container: {r.name}")
+                print(f"  Index: {r.index}")
+                print(f"  State: {'Running' if r.state == 1 else 'Stopped'}")
+                print(f"  CPU: {r.cpuHundredths/100:.2f}%")
+                print(f"  Memory: {r.memBytes/1024/1024:.2f} MB / {r.memLimitBytes/1024/1024:.2f} MB")
+                print(f"  Restarts: {r.restartCount}")
                 print()
             print("✓ Test completed successfully!", file=sys.stderr)
             return
@@ -215,150 +210,144 @@ def main():
             traceback.print_exc(file=sys.stderr)
             sys.exit(1)
 
-    cache_data = None
-    cache_time = 0
-    cache_ttl = 5.0
+    refresh_interval = args.cache_ttl
 
-    def get_cached_rows():
-        """Get cached rows or fetch fresh data if cache expired."""
-        nonlocal cache_data, cache_time
-        now = time.time()
-        if cache_data is None or (now - cache_time) > cache_ttl:
-            cache_data = build_rows(args.url)
-            cache_time = now
-        return cache_data
-
-    def build_oid_map(rows):
-        """Build a map of OID -> (type, value) for fast lookup."""
-        oid_map = {}
+    def build_oid_map(rows: list[Row]) -> tuple[dict[str, str], list[tuple[int, ...]], list[str]]:
+        """Build the pass_persist replies for every OID.
+
+        Returns a map of OID -> formatted reply for get, and the OID tuples
+        with their replies in OID order for getnext. build_rows() returns
+        rows sorted by index, so emitting columns 1-6 row by row is already
+        in OID order.
+        """
+        responses = {}
+        sorted_tuples = []
+        next_responses = []
         for r in rows:
-            idx = r["index"]
-            base = f"{BASE_OID}.{idx}"
-            oid_map[f"{base}.1"] = ("string", r["name"])
-            oid_map[f"{base}.2"] = ("integer", r["state"])
-            oid_map[f"{base}.3"] = ("integer", r["cpuHundredths"])
-            oid_map[f"{base}.4"] = ("counter64", r["memBytes"])
-            oid_map[f"{base}.5"] = ("counter64", r["memLimitBytes"])
-            oid_map[f"{base}.6"] = ("counter32", r["restartCount"])
-        return oid_map
+            base = _OID_PREFIX + str(r.index) + "."
+            for column, oid_type, oid_value in ((1, "string", r.name),
+                                                (2, "integer", r.state),
+                                                (3, "integer", r.cpuHundredths),
+                                                (4, "counter64", r.memBytes),
+                                                (5, "counter64", r.memLimitBytes),
+                                                (6, "counter32", r.restartCount)):
+                oid = base + str(column)
+                response = f"{oid}\n{oid_type}\n{oid_value}\n"
+                responses[oid] = response
+                sorted_tuples.append(oid_to_tuple(oid))
+                next_responses.append(response)
+        return responses, sorted_tuples, next_responses
+
+    # (replies by OID, OID tuples in order, replies in OID order). The
+    # refresh thread replaces the whole tuple at once, and handlers read it
+    # into locals, so a request never sees parts of two refreshes.
+    snapshot = build_oid_map(build_rows(url))
+
+    def refresh_loop() -> None:
+        """Rebuild the snapshot from cAdvisor every refresh_interval seconds."""
+        nonlocal snapshot
+        while True:
+            try:
+                time.sleep(refresh_interval)
+                snapshot = build_oid_map(build_rows(url))
+            except Exception as e:
+                print(f"ERROR in refresh: {e}", file=sys.stderr)
+                sys.stderr.flush()
+
+    # SNMP requests are answered from the snapshot only, so their latency
+    # doesn't depend on cAdvisor's.
+    threading.Thread(target=refresh_loop, name="cadvisor-refresh", daemon=True).start()
+
+    # snmpd waits for each reply; line buffering flushes every response as
+    # it is written, so replies are sent with a single write each.
+    sys.stdout.reconfigure(line_buffering=True)
+    out = sys.stdout
+
+    def handle_ping(rest: str) -> None:
+        out.write("PONG\n")
+
+    def handle_get(rest: str) -> None:
+        requested_oid = rest.strip()
+        if not requested_oid:
+            oid_line = sys.stdin.readline()
+            requested_oid = oid_line.strip() if oid_line else ""
+        if not requested_oid:
+            out.write("NONE\n")
+            return
+        oid = normalize_oid(requested_oid)
+        try:
+            responses = snapshot[0]
+            out.write(responses.get(oid, "NONE\n"))
+        except Exception as e:
+            print(f"ERROR in get: {e}", file=sys.stderr)
+            sys.stderr.flush()
+            out.write("NONE\n")
+
+    def reply_next(requested_oid: str | None) -> None:
+        if not requested_oid:
+            out.write("END\n")
+            return
+        try:
+            _, sorted_tuples, next_responses = snapshot
+            i = bisect.bisect_right(sorted_tuples, oid_to_tuple(requested_oid))
+            if i < len(next_responses):
+                out.write(next_responses[i])
+            else:
+                out.write("END\n")
+        except Exception as e:
+            print(f"ERROR in getnext/getbulk: {e}", file=sys.stderr)
+            import traceback
+            traceback.print_exc(file=sys.stderr)
+            sys.stderr.flush()
+            out.write("END\n")
+
+    def handle_getnext(rest: str) -> None:
+        parts = rest.split()
+        if parts:
+            requested_oid = parts[-1]
+        else:
+            oid_line = sys.stdin.readline()
+            requested_oid = oid_line.strip() if oid_line else None
+        reply_next(requested_oid)
+
+    def handle_getbulk(rest: str) -> None:
+        parts = rest.split()
+        requested_oid = None
+        if len(parts) >= 3:
+            requested_oid = parts[-1]
+        else:
+            line1 = sys.stdin.readline()
+            if line1:
+                line2 = sys.stdin.readline()
+                if line2:
+                    oid_line = sys.stdin.readline()
+                    if oid_line:
+                        requested_oid = oid_line.strip()
+        reply_next(requested_oid)
+
+    handlers = {
+        "PING": handle_ping,
+        "get": handle_get,
+        "getnext": handle_getnext,
+        "getbulk": handle_getbulk,
+    }
 
     while True:
         try:
             line = sys.stdin.readline()
             if not line:
                 break
-            
+
             cmd = line.strip()
             if not cmd:
                 continue
 
-            if cmd == "PING":
-                print("PONG")
-                sys.stdout.flush()
-                continue
-
-            if cmd.startswith("get "):
-                oid = normalize_oid(cmd[4:].strip())
-                try:
-                    rows = get_cached_rows()
-                    oid_map = build_oid_map(rows)
-                    
-                    if oid in oid_map:
-                        oid_type, oid_value = oid_map[oid]
-                        print(oid)
-                        print(oid_type)
-                        print(oid_value)
-                    else:
-                        print("NONE")
-                except Exception as e:
-                    print(f"ERROR in get: {e}", file=sys.stderr)
-                    sys.stderr.flush()
-                    print("NONE")
-                sys.stdout.flush()
-                continue
-
-            if cmd.startswith("getnext") or cmd.startswith("getbulk"):
-                parts = cmd.split()
-                requested_oid = None
-
-                if cmd.startswith("getbulk"):
-                    if len(parts) >= 4:
-                        requested_oid = parts[-1].strip()
-                    else:
-                        line1 = sys.stdin.readline()
-                        if line1:
-                            line2 = sys.stdin.readline()
-                            if line2:
-                                oid_line = sys.stdin.readline()
-                                if oid_line:
-                                    requested_oid = oid_line.strip()
-                elif len(parts) >= 2:
-                    requested_oid = parts[-1].strip()
-                else:
-                    oid_line = sys.stdin.readline()
-                    if oid_line:
-                        requested_oid = oid_line.strip()
-
-                if not requested_oid:
-                    print("END")
-                    sys.stdout.flush()
-                    continue
-
-                try:
-                    rows = get_cached_rows()
-                    if not rows:
-                        print("END")
-                        sys.stdout.flush()
-                        continue
-
-                    all_oids = []
-                    for r in rows:
-                        idx = r["index"]
-                        base = f"{BASE_OID}.{idx}"
-                        all_oids.append((f"{base}.1", "string", r["name"]))
-                        all_oids.append((f"{base}.2", "integer", r["state"]))
-                        all_oids.append((f"{base}.3", "integer", r["cpuHundredths"]))
-                        all_oids.append((f"{base}.4", "counter64", r["memBytes"]))
-                        all_oids.append((f"{base}.5", "counter64", r["memLimitBytes"]))
-                        all_oids.append((f"{base}.6", "counter32", r["restartCount"]))
-
-                    requested_tuple = oid_to_tuple(requested_oid)
-                    base_tuple = oid_to_tuple(BASE_OID)
-
-                    sorted_oids = sorted(all_oids, key=lambda x: oid_to_tuple(x[0]))
-                    next_oid = None
-
-                    if requested_tuple == base_tuple:
-                        if sorted_oids:
-                            next_oid = sorted_oids[0]
-                    else:
-                        for oid_str, oid_type, oid_value in sorted_oids:
-                            oid_tuple = oid_to_tuple(oid_str)
-                            if oid_tuple > requested_tuple:
-                                next_oid = (oid_str, oid_type, oid_value)
-                                break
-
-                    if next_oid:
-                        output_oid = normalize_oid(next_oid[0])
-                        print(output_oid)
-                        print(next_oid[1])
-                        print(next_oid[2])
-                    else:
-                        print("END")
-
-                except Exception as e:
-                    print(f"ERROR in getnext/getbulk: {e}", file=sys.stderr)
-                    import traceback
-                    traceback.print_exc(file=sys.stderr)
-                    sys.stderr.flush()
-                    print("END")
-
-                sys.stdout.flush()
-                continue
-
-            print("NONE")
-            sys.stdout.flush()
-            continue
+            verb, _, rest = cmd.partition(" ")
+            handler = handlers.get(verb)
+            if handler is None:
+                out.write("NONE\n")
+            else:
+                handler(rest)
 
         except KeyboardInterrupt:
             break
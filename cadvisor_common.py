@@ -0,0 +1,377 @@
+"""
+Shared helpers for the cAdvisor SNMP bridge scripts.
+Fetches container data from cAdvisor and extracts per-container metrics.
+"""
+import sys
+import time
+import json
+import datetime
+import functools
+import calendar
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    print("ERROR: 'requests' module is not installed.", file=sys.stderr)
+    print("Install it with: pip3 install requests", file=sys.stderr)
+    sys.exit(1)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Both scripts only ever talk to a single cAdvisor host, one request at a time.
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+VALID_STATES = frozenset(["running", "exited", "paused", "restarting", "created", "removing", "dead"])
+_STATE_MAP = {s: s for s in VALID_STATES}
+_STATE_MAP.update({"stopped": "exited", "up": "running", "active": "running"})
+STATE_MAX_AGE = 300
+
+_UTC = datetime.timezone.utc
+_fromisoformat = datetime.datetime.fromisoformat
+_strptime = datetime.datetime.strptime
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_timestamp(ts: str | None) -> float | None:
+    """Parse RFC3339 timestamp to Unix timestamp.
+
+    Handles cAdvisor's nanosecond precision timestamps like:
+    '2025-12-05T09:26:39.031046195Z'
+    Timestamps ending in 'Z' or a +HH:MM/-HH:MM offset are sliced at fixed
+    positions; anything else falls back to datetime parsing.
+
+    Results are memoized, as the same timestamps are parsed by several
+    helpers for every container.
+    """
+    if not ts:
+        return None
+    if (len(ts) >= 20 and ts[4] == "-" and ts[7] == "-" and ts[10] == "T"
+            and ts[13] == ":" and ts[16] == ":"):
+        try:
+            if ts[-1] == "Z":
+                end = len(ts) - 1
+                offset = 0
+            elif ts[-6] in "+-" and ts[-3] == ":":
+                end = len(ts) - 6
+                offset = int(ts[-5:-3]) * 3600 + int(ts[-2:]) * 60
+                if ts[-6] == "-":
+                    offset = -offset
+            else:
+                raise ValueError(ts)
+            if end < 19:
+                raise ValueError(ts)
+            year, month, day = int(ts[0:4]), int(ts[5:7]), int(ts[8:10])
+            hour, minute, second = int(ts[11:13]), int(ts[14:16]), int(ts[17:19])
+            # timegm() silently normalizes out-of-range fields (Feb 30 ->
+            # Mar 2); leave those to datetime, which rejects them.
+            if (not 1 <= month <= 12 or day < 1
+                    or (day > 28 and day > calendar.monthrange(year, month)[1])
+                    or not 0 <= hour <= 23 or not 0 <= minute <= 59 or not 0 <= second <= 59):
+                raise ValueError(ts)
+            seconds = calendar.timegm((year, month, day, hour, minute, second))
+            micros = 0
+            if end > 19:
+                if ts[19] != ".":
+                    raise ValueError(ts)
+                micros = int(ts[20:end][:6].ljust(6, "0"))
+            return ((seconds - offset) * 1000000 + micros) / 1e6
+        except ValueError:
+            pass
+    try:
+        ts_iso = ts.replace("Z", "+00:00")
+        if "." in ts_iso and "+" in ts_iso:
+            parts = ts_iso.split(".")
+            if len(parts) == 2:
+                decimal_part = parts[1].split("+")[0]
+                if len(decimal_part) > 6:
+                    decimal_part = decimal_part[:6]
+                ts_iso = parts[0] + "." + decimal_part + "+" + parts[1].split("+")[1]
+        return _fromisoformat(ts_iso).timestamp()
+    except ValueError:
+        try:
+            ts_clean = ts.split(".")[0].rstrip("Z")
+            dt = _strptime(ts_clean, "%Y-%m-%dT%H:%M:%S")
+            if ts.endswith("Z"):
+                dt = dt.replace(tzinfo=_UTC)
+            return dt.timestamp()
+        except Exception:
+            return None
+
+def dget(obj: object, *keys: str, default: object = None) -> object:
+    """Look up a path of keys in nested dicts.
+
+    Returns default if any level is missing, None or not a dict, which
+    covers malformed cAdvisor responses without per-level checks.
+    """
+    for key in keys:
+        if not isinstance(obj, dict):
+            return default
+        obj = obj.get(key)
+        if obj is None:
+            return default
+    return obj
+
+def api_url(cadvisor_url: str) -> str:
+    """Build the cAdvisor Docker containers endpoint from the base URL."""
+    return cadvisor_url.rstrip("/") + "/api/v1.3/docker"
+
+def fetch_containers(url: str, timeout: float = 2.0, num_stats: int | None = None) -> dict:
+    """Fetch container data from cAdvisor API endpoint url (see api_url()).
+
+    cAdvisor returns 60 stats samples per container by default; num_stats
+    asks for only the most recent ones, which keeps the response (and the
+    decoded dict tree) small on hosts with many containers.
+    """
+    query = {"num_stats": num_stats} if num_stats else None
+    r = _SESSION.get(url, timeout=timeout, json=query)
+    r.raise_for_status()
+    if orjson is not None:
+        return orjson.loads(r.content)
+    return r.json()
+
+def calc_cpu_percent(c: dict) -> float:
+    """Calculate CPU usage percentage from cumulative counter.
+
+    cAdvisor reports CPU usage as a cumulative counter (like Prometheus).
+    We calculate the rate of change over a time window to get CPU percentage.
+    Uses the last 2-5 stats points (if available) for stability.
+    """
+    stats = c.get("stats", [])
+    if len(stats) < 2:
+        return 0.0
+
+    valid_points = []
+    for stat in reversed(stats[-5:]):
+        cu_total = dget(stat, "cpu", "usage", "total")
+        ts = dget(stat, "timestamp")
+        if cu_total is None or not ts:
+            continue
+        ts_parsed = parse_timestamp(ts)
+        if ts_parsed is None:
+            continue
+        valid_points.append((ts_parsed, cu_total))
+
+    if len(valid_points) < 2:
+        return 0.0
+
+    # Points are newest first, so the widest window is newest vs. oldest.
+    ts_b, total_b = valid_points[0]
+    ts_a, total_a = valid_points[-1]
+    dt = max(0.1, ts_b - ts_a)
+
+    delta_ns = total_b - total_a
+
+    if delta_ns < 0 and abs(delta_ns) > total_a * 0.5:
+        return 0.0
+    delta_ns = max(0, delta_ns)
+
+    cpu_rate = (delta_ns / 1e9) / dt
+
+    cpu_limit = dget(c, "spec", "cpu", "limit", default=0)
+    cpu_count = dget(c, "spec", "cpu", "count", default=1)
+    if cpu_limit and cpu_limit >= 1e9:
+        cpus = cpu_limit / 1e9
+    elif cpu_count and cpu_count > 0:
+        cpus = cpu_count
+    else:
+        cpus = 1
+    cpus = max(1, cpus)
+
+    return round(min(100.0, cpu_rate * 100.0 / cpus), 2)
+
+def state_cutoff(now: float, max_age: float = STATE_MAX_AGE) -> str:
+    """Format the oldest still-fresh time as an RFC3339 UTC prefix.
+
+    RFC3339 UTC timestamps sort lexicographically, so comparing the first
+    19 characters of a sample timestamp against this string tells whether
+    it is older than max_age without parsing it.
+    """
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now - max_age))
+
+def get_state(c: dict, now: float | None = None, cutoff: str | None = None) -> str:
+    """Get container state: running or stopped.
+
+    cAdvisor only tracks running containers, so if stats exist and are recent
+    (< 5 minutes old), the container is running. Pass now to evaluate
+    several containers against the same reference time, and cutoff (see
+    state_cutoff()) to skip parsing UTC timestamps.
+    """
+    stats = c.get("stats", [])
+    if not stats:
+        return "stopped"
+
+    ts = dget(stats[-1], "timestamp")
+    if ts:
+        if cutoff is not None and len(ts) >= 20 and ts[10] == "T" and ts[-1] == "Z":
+            return "stopped" if ts[:19] < cutoff else "running"
+        t_last = parse_timestamp(ts)
+        if now is None:
+            now = time.time()
+        if t_last and (now - t_last) > STATE_MAX_AGE:
+            return "stopped"
+    return "running"
+
+def get_mem(c: dict) -> tuple[int, int]:
+    """Get memory usage and limit in bytes."""
+    stats = c.get("stats")
+    if not stats:
+        return 0, 0
+    latest = stats[-1]
+    if not isinstance(latest, dict):
+        return 0, 0
+
+    m = latest.get("memory")
+    if isinstance(m, dict):
+        usage = int(m["usage"]) if "usage" in m else 0
+    elif isinstance(m, (int, float)):
+        usage = int(m)
+    else:
+        usage = 0
+
+    limit = dget(c, "spec", "memory", "limit")
+    return usage, int(limit) if limit is not None else 0
+
+def get_name(c_id: str, c: dict) -> str:
+    """Extract container name from various sources."""
+    aliases = c.get("aliases") or []
+    if aliases:
+        return aliases[0].lstrip("/")
+    name = dget(c, "spec", "labels", "io.kubernetes.container.name")
+    if name:
+        return name
+    return c.get("name", c_id)[:12].lstrip("/")
+
+def get_pids(c: dict) -> int:
+    """Get process count (PIDs) from container stats."""
+    stats = c.get("stats")
+    if not stats:
+        return 0
+    latest = stats[-1]
+    if not isinstance(latest, dict):
+        return 0
+
+    processes = latest.get("processes")
+    if isinstance(processes, dict):
+        pids = processes.get("process_count")
+        if pids:
+            return int(pids)
+    elif isinstance(processes, (int, float)):
+        return int(processes)
+
+    cpu = latest.get("cpu")
+    if isinstance(cpu, dict) and "processes" in cpu:
+        cpu_processes = cpu["processes"]
+        if isinstance(cpu_processes, list):
+            return len(cpu_processes)
+        elif isinstance(cpu_processes, (int, float)):
+            return int(cpu_processes)
+    return 0
+
+def get_uptime(c: dict, now: float | None = None) -> int | None:
+    """Calculate container uptime in seconds from creation_time."""
+    creation_time = dget(c, "spec", "creation_time")
+    if not creation_time:
+        return None
+    creation_ts = parse_timestamp(creation_time)
+    if creation_ts:
+        if now is None:
+            now = time.time()
+        return max(0, int(now - creation_ts))
+    return None
+
+def _fs_capacity(fs: dict) -> int | float:
+    """Get the total capacity of a filesystem stats entry, or 0."""
+    capacity = fs.get("capacity")
+    if isinstance(capacity, dict):
+        return capacity.get("total", 0)
+    if isinstance(capacity, (int, float)):
+        return capacity
+    return 0
+
+def get_filesystem_sizes(c: dict) -> tuple[int | None, int | None]:
+    """Get filesystem size metrics: size_rw and size_root_fs.
+
+    Note: cAdvisor doesn't expose Docker's size_rw (writable layer size).
+    Returns (None, size_root_fs) where size_root_fs is from filesystem stats.
+    As a last resort, filesystem usage is taken from the newest sample that
+    has it; only the samples that were fetched (see num_stats) are searched.
+    """
+    stats = c.get("stats")
+    if not stats:
+        return None, None
+
+    latest = stats[-1]
+    if not isinstance(latest, dict):
+        return None, None
+
+    filesystem = latest.get("filesystem")
+    if filesystem and isinstance(filesystem, list):
+        for fs in filesystem:
+            if not isinstance(fs, dict):
+                continue
+            device = fs.get("device") or ""
+            if device == "/" or "root" in device.lower():
+                size_root_fs = _fs_capacity(fs)
+                if size_root_fs:
+                    return None, int(size_root_fs)
+
+    filesystem_spec = dget(c, "spec", "filesystem")
+    if isinstance(filesystem_spec, dict):
+        size_rw = filesystem_spec.get("size_rw") or filesystem_spec.get("sizeRw")
+        size_root_fs = filesystem_spec.get("size_root_fs") or filesystem_spec.get("sizeRootFs")
+        if size_rw or size_root_fs:
+            return (int(size_rw) if size_rw else None,
+                    int(size_root_fs) if size_root_fs else None)
+
+    for stat in reversed(stats):
+        if not isinstance(stat, dict):
+            continue
+        fs_info = stat.get("filesystem")
+        if fs_info and isinstance(fs_info, list):
+            for fs in fs_info:
+                if not isinstance(fs, dict):
+                    continue
+                usage = fs.get("usage")
+                if isinstance(usage, dict):
+                    total = usage.get("total", 0)
+                    if total:
+                        return None, int(total)
+                elif isinstance(usage, (int, float)) and usage:
+                    return None, int(usage)
+    return None, None
+
+@functools.lru_cache(maxsize=2048)
+def format_memory_string(bytes_value: int) -> str:
+    """Format memory bytes as a string for LibreNMS Number::toBytes()."""
+    if bytes_value == 0:
+        return "0B"
+    for shift, unit in ((30, "GiB"), (20, "MiB"), (10, "KiB")):
+        if bytes_value >= 1 << shift:
+            hundredths, rem = divmod(bytes_value * 100, 1 << shift)
+            # Round half to even, matching "%.2f" on the exact quotient.
+            half = 1 << (shift - 1)
+            if rem > half or (rem == half and hundredths & 1):
+                hundredths += 1
+            whole, frac = divmod(hundredths, 100)
+            return f"{whole}.{frac:02d}{unit}"
+    return f"{bytes_value}B"
+
+def normalize_state(state: str | int | float) -> str:
+    """Normalize container state to valid Docker status."""
+    if isinstance(state, str):
+        return _STATE_MAP.get(state.lower().strip(), "exited")
+    elif isinstance(state, (int, float)):
+        return "running" if state == 1 else "exited"
+    return "running"
+
+def json_dumps(obj: object) -> bytes:
+    """Serialize obj to JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()